@@ -3,18 +3,32 @@ Get PiJuice UPS hat information and publish to MQTT for consumption by eg Node-R
 """
 
 import argparse
-import platform
+import asyncio
+import json
+import os
 import signal
-import sys
-import threading
-from json import dumps
 
 import paho.mqtt.client as mqtt
 import yaml
 from pijuice import PiJuice
 from pijuice import __version__ as library_version
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader
+
+try:
+    from orjson import dumps
+except ImportError:  # orjson has no wheels for some Pi models, eg armv6l
+
+    def dumps(obj):
+        """Serialize `obj` to compact UTF-8 JSON bytes, like `orjson.dumps`."""
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
 SERVICE_NAME = "pijuicemqtt"
+PAYLOAD_ONLINE = b"online"
+PAYLOAD_OFFLINE = b"offline"
 
 parser = argparse.ArgumentParser(description="PiJuice to MQTT")
 parser.add_argument(
@@ -27,13 +41,14 @@ parser.add_argument(
 args = parser.parse_args()
 
 pijuice = PiJuice(1, 0x14)  # Instantiate PiJuice interface object
-timer_thread = None
+loop = None
+publish_task = None
 
 
 def load_config(config_file):
     """Load the configuration from config yaml file and use it to override the defaults."""
     with open(config_file, "r") as f:
-        config_override = yaml.safe_load(f)
+        config_override = yaml.load(f, Loader=SafeLoader)
 
     default_config = {
         "mqtt": {
@@ -47,185 +62,272 @@ def load_config(config_file):
             "sensor": True,
         },
         "publish_period": 30,
-        "hostname": platform.node(),
+        "hostname": os.uname().nodename,
     }
 
     config = {**default_config, **config_override}
     return config
 
 
+def build_device_block():
+    """Build the Home Assistant device description shared by all autoconfig messages."""
+    battery_capacity = pijuice.config.GetBatteryProfile()["data"]["capacity"]
+    firmware_version = pijuice.config.GetFirmwareVersion()["data"]["version"]
+    return {
+        "identifiers": [f"{SERVICE_NAME}-{HOSTNAME}"],
+        "name": f"{HOSTNAME} PiJuice",
+        "sw_version": f"Library {library_version}, Firmware {firmware_version}",
+        "model": f"PiJuice {battery_capacity} mAh",
+        "manufacturer": "PiSupply",
+    }
+
+
+def build_ha_autoconfig():
+    """
+    Build the Home Assistant MQTT autoconfig messages.
+
+    Returns a list of `(topic, payload)` tuples. Hostname, firmware and battery capacity do not change
+    while running, so this is built once at startup and replayed on every connect.
+    """
+    # Payload that is common to all autoconfig messages
+    base_payload = {
+        "availability_topic": TOPIC_SERVICE,
+        "payload_available": "online",
+        "payload_not_available": "offline",
+        "state_topic": TOPIC_STATUS,
+        "json_attributes_topic": TOPIC_STATUS,
+        "device": DEVICE_BLOCK,
+    }
+
+    if "expire_after" in config["homeassistant"]:
+        base_payload["expire_after"] = int(config["homeassistant"]["expire_after"])
+
+    autoconfig = []
+    for key, topic_prefix, name, extra in SENSORS:
+        payload = {
+            "name": f"{HOSTNAME} PiJuice {name}",
+            "unique_id": f"{SERVICE_NAME}-{HOSTNAME}-{key}",
+            "value_template": f"{{{{ value_json.{key} }}}}",
+            **extra,
+        }
+        autoconfig.append((f"{topic_prefix}/{key}/config", dumps({**base_payload, **payload})))
+    return autoconfig
+
+
 def mqtt_on_connect(client, userdata, flags, reason_code, properties):
     """Renew subscriptions and set Last Will message when connect to broker."""
     # Set up Last Will, and then set services' status to 'online'
     client.will_set(
-        f"{SERVICE_NAME}/{config['hostname']}/service",
-        payload="offline",
+        TOPIC_SERVICE,
+        payload=PAYLOAD_OFFLINE,
         qos=1,
         retain=True,
     )
     client.publish(
-        f"{SERVICE_NAME}/{config['hostname']}/service",
-        payload="online",
+        TOPIC_SERVICE,
+        payload=PAYLOAD_ONLINE,
         qos=1,
         retain=True,
     )
 
-    # Home Assistant MQTT autoconfig
+    # Home Assistant MQTT autoconfig. Also resend it whenever Home Assistant comes back online
     if config["homeassistant"]["sensor"]:
-        print("Publishing Home Assistant MQTT autoconfig")
-        # Payload that is common to both autoconfig messages
-        battery_capacity = pijuice.config.GetBatteryProfile()["data"]["capacity"]
-        firmware_version = pijuice.config.GetFirmwareVersion()["data"]["version"]
-        base_payload = {
-            "availability_topic": f"{SERVICE_NAME}/{config['hostname']}/service",
-            "payload_available": "online",
-            "payload_not_available": "offline",
-            "state_topic": f"{SERVICE_NAME}/{config['hostname']}/status",
-            "json_attributes_topic": f"{SERVICE_NAME}/{config['hostname']}/status",
-            "device": {
-                "identifiers": [f"{SERVICE_NAME}-{config['hostname']}"],
-                "name": f"{config['hostname']} PiJuice",
-                "sw_version": f"Library {library_version}, Firmware {firmware_version}",
-                "model": f"PiJuice {battery_capacity} mAh",
-                "manufacturer": "PiSupply",
-            },
-        }
+        publish_ha_autoconfig(client)
+        client.subscribe(TOPIC_HA_STATUS)
 
-        if "expire_after" in config["homeassistant"]:
-            base_payload["expire_after"] = int(config["homeassistant"]["expire_after"])
 
-        # Battery charge percentage
-        payload = {
-            "name": f"{config['hostname']} PiJuice Battery",
-            "unique_id": f"{SERVICE_NAME}-{config['hostname']}-batteryCharge",
-            "value_template": "{{ value_json.batteryCharge }}",
-            "device_class": "battery",
-            "unit_of_measurement": "%",
-        }
-        client.publish(
-            f"{config['homeassistant']['topic']}/sensor/{SERVICE_NAME}-{config['hostname']}/batteryCharge/config",
-            dumps({**base_payload, **payload}),
-            qos=1,
-            retain=True,
-        )
+def mqtt_on_message(client, userdata, message):
+    """Resend Home Assistant MQTT autoconfig when Home Assistant announces it is online."""
+    if message.topic == TOPIC_HA_STATUS and message.payload == PAYLOAD_ONLINE:
+        publish_ha_autoconfig(client)
 
-        # Power/No Power binary sensor
-        payload = {
-            "name": f"{config['hostname']} PiJuice PowerInput5vIo",
-            "unique_id": f"{SERVICE_NAME}-{config['hostname']}-powerInput5vIo",
-            "value_template": "{{ value_json.powerInput5vIo }}",
-            "payload_off": "NOT_PRESENT",
-            "payload_on": "PRESENT",
-            "device_class": "power",
-        }
-        client.publish(
-            f"{config['homeassistant']['topic']}/binary_sensor/{SERVICE_NAME}-{config['hostname']}/powerInput5vIo/config",
-            dumps({**base_payload, **payload}),
-            qos=1,
-            retain=True,
-        )
 
-        # Battery Temperature sensor
-        payload = {
-            "name": f"{config['hostname']} PiJuice BatteryTemperature",
-            "unique_id": f"{SERVICE_NAME}-{config['hostname']}-batteryTemperature",
-            "value_template": "{{ value_json.batteryTemperature }}",
-            "device_class": "temperature",
-            "unit_of_measurement": "°C",
-            "enabled_by_default": False,
-            "entity_category": "diagnostic",
-        }
-        client.publish(
-            f"{config['homeassistant']['topic']}/sensor/{SERVICE_NAME}-{config['hostname']}/batteryTemperature/config",
-            dumps({**base_payload, **payload}),
-            qos=1,
-            retain=True,
-        )
+def publish_ha_autoconfig(client):
+    """Publish the prebuilt Home Assistant MQTT autoconfig messages."""
+    print("Publishing Home Assistant MQTT autoconfig")
+    for topic, payload in _HA_AUTOCONFIG:
+        client.publish(topic, payload, qos=1, retain=True)
 
-        # Battery Status sensor
-        payload = {
-            "name": f"{config['hostname']} PiJuice BatteryStatus",
-            "unique_id": f"{SERVICE_NAME}-{config['hostname']}-batteryStatus",
-            "value_template": "{{ value_json.batteryStatus }}",
-            "enabled_by_default": False,
-            "entity_category": "diagnostic",
-        }
-        client.publish(
-            f"{config['homeassistant']['topic']}/sensor/{SERVICE_NAME}-{config['hostname']}/batteryStatus/config",
-            dumps({**base_payload, **payload}),
-            qos=1,
-            retain=True,
-        )
 
 def on_exit(signum, frame):
     """
-    Update MQTT services' status to `offline` and stop the timer thread.
+    Update MQTT services' status to `offline`, stop the MQTT network thread and cancel the publish task.
 
     Called when program exit is received.
     """
     print("Exiting...")
-    client.publish(
-        f"{SERVICE_NAME}/{config['hostname']}/service",
-        payload="offline",
+    message = client.publish(
+        TOPIC_SERVICE,
+        payload=PAYLOAD_OFFLINE,
         qos=1,
         retain=True,
     )
-    timer_thread.cancel()
-    timer_thread.join()
-    sys.exit(0)
+    if message.rc == mqtt.MQTT_ERR_SUCCESS:
+        try:
+            message.wait_for_publish(timeout=5)
+        except (RuntimeError, ValueError):
+            pass  # Connection lost while waiting; the broker publishes the Last Will instead
+    client.disconnect()
+    client.loop_stop()
+    publish_task.cancel()
 
 
-def publish_pijuice():
+def read_pijuice_status():
     """
-    Publish PiJuice UPS Hat information every `publish_period` seconds.
+    Read all PiJuice status values.
 
-    See https://github.com/PiSupply/PiJuice/tree/master/Software#i2c-command-api
+    Each value is a separate PiJuice I2C command read through the library, which verifies its checksum.
+    Returns a tuple of raw values: charge (%), battery voltage (mV), battery current (mA),
+    battery temperature (°C), status dict, IO voltage (mV), IO current (mA).
+    Raises `KeyError` if any read fails, or `OSError` on an I2C bus error.
     """
-    global timer_thread
-    timer_thread = threading.Timer(config["publish_period"], publish_pijuice)
-    timer_thread.start()
+    status = pijuice.status
+    return (
+        status.GetChargeLevel()["data"],
+        status.GetBatteryVoltage()["data"],
+        status.GetBatteryCurrent()["data"],
+        status.GetBatteryTemperature()["data"],
+        status.GetStatus()["data"],
+        status.GetIoVoltage()["data"],
+        status.GetIoCurrent()["data"],
+    )
 
-    try:
 
-        if "publish_online_status" in config and config["publish_online_status"]:
-            client.publish(
-                f"{SERVICE_NAME}/{config['hostname']}/service",
-                payload="online",
-                qos=1,
-                retain=True,
-            )
-
-        status = pijuice.status.GetStatus()["data"]
-        pijuice_status = {
-            "batteryCharge": pijuice.status.GetChargeLevel()["data"],
-            "batteryVoltage": pijuice.status.GetBatteryVoltage()["data"] / 1000,
-            "batteryCurrent": pijuice.status.GetBatteryCurrent()["data"] / 1000,
-            "batteryTemperature": pijuice.status.GetBatteryTemperature()["data"],
-            "batteryStatus": status["battery"],
-            "powerInput": status["powerInput"],
-            "powerInput5vIo": status["powerInput5vIo"],
-            "ioVoltage": pijuice.status.GetIoVoltage()["data"] / 1000,
-            "ioCurrent": pijuice.status.GetIoCurrent()["data"] / 1000,
-        }
+def publish_once():
+    """
+    Publish PiJuice UPS Hat information once.
+
+    See https://github.com/PiSupply/PiJuice/tree/master/Software#i2c-command-api
+    """
+    if PUBLISH_ONLINE:
         client.publish(
-            f"{SERVICE_NAME}/{config['hostname']}/status",
-            dumps(pijuice_status),
+            TOPIC_SERVICE,
+            payload=PAYLOAD_ONLINE,
+            qos=1,
+            retain=True,
         )
-    except KeyError:
+
+    # Retry a failed read once straight away rather than skipping a whole period
+    for _ in range(2):
+        try:
+            charge, v_batt_mv, i_batt_ma, temperature, status, v_io_mv, i_io_ma = read_pijuice_status()
+            break
+        except (OSError, KeyError):
+            continue
+    else:
         print("Could not read PiJuice data, skipping")
+        return
+
+    # True division (not `* 0.001`) keeps values like 4.161 exact in the JSON output
+    pijuice_status = {
+        "batteryCharge": charge,
+        "batteryVoltage": v_batt_mv / 1000,
+        "batteryCurrent": i_batt_ma / 1000,
+        "batteryTemperature": temperature,
+        "batteryStatus": status["battery"],
+        "powerInput": status["powerInput"],
+        "powerInput5vIo": status["powerInput5vIo"],
+        "ioVoltage": v_io_mv / 1000,
+        "ioCurrent": i_io_ma / 1000,
+    }
+    # paho sends bytes payloads as-is; copying into a reused bytearray would only add a copy
+    client.publish(
+        TOPIC_STATUS,
+        dumps(pijuice_status),
+    )
+
+
+async def publish_pijuice():
+    """Publish PiJuice UPS Hat information every `publish_period` seconds until cancelled."""
+    # Schedule against absolute deadlines so read/publish time does not accumulate as drift
+    next_deadline = loop.time()
+    while True:
+        publish_once()
+        next_deadline += PERIOD
+        now = loop.time()
+        if next_deadline < now:
+            # Stalled for more than a period; skip the missed ticks rather than publish back-to-back
+            next_deadline = now
+        await asyncio.sleep(next_deadline - now)
+
+
+async def main():
+    """Run the publish loop on the asyncio event loop until the task is cancelled by `on_exit`."""
+    global loop, publish_task
+    loop = asyncio.get_running_loop()
+    publish_task = asyncio.create_task(publish_pijuice())
+    # Installed here so `on_exit` can never run before the loop and task exist
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, on_exit, signum, None)
+    try:
+        await publish_task
+    except asyncio.CancelledError:
+        pass
 
 
 config = load_config(args.config_file)
+HOSTNAME = config["hostname"]
+PERIOD = config["publish_period"]
+PUBLISH_ONLINE = bool(config.get("publish_online_status"))
+
+# MQTT topics are fixed for the life of the process
+TOPIC_SERVICE = f"{SERVICE_NAME}/{HOSTNAME}/service"
+TOPIC_STATUS = f"{SERVICE_NAME}/{HOSTNAME}/status"
+TOPIC_HA_SENSOR = f"{config['homeassistant']['topic']}/sensor/{SERVICE_NAME}-{HOSTNAME}"
+TOPIC_HA_BINARY_SENSOR = f"{config['homeassistant']['topic']}/binary_sensor/{SERVICE_NAME}-{HOSTNAME}"
+TOPIC_HA_STATUS = f"{config['homeassistant']['topic']}/status"
+
+# Home Assistant autoconfig entities: (status key, discovery topic prefix, name, extra payload)
+SENSORS = [
+    # Battery charge percentage
+    ("batteryCharge", TOPIC_HA_SENSOR, "Battery", {"device_class": "battery", "unit_of_measurement": "%"}),
+    # Power/No Power binary sensor
+    (
+        "powerInput5vIo",
+        TOPIC_HA_BINARY_SENSOR,
+        "PowerInput5vIo",
+        {"payload_off": "NOT_PRESENT", "payload_on": "PRESENT", "device_class": "power"},
+    ),
+    # Battery Temperature sensor
+    (
+        "batteryTemperature",
+        TOPIC_HA_SENSOR,
+        "BatteryTemperature",
+        {
+            "device_class": "temperature",
+            "unit_of_measurement": "°C",
+            "enabled_by_default": False,
+            "entity_category": "diagnostic",
+        },
+    ),
+    # Battery Status sensor
+    (
+        "batteryStatus",
+        TOPIC_HA_SENSOR,
+        "BatteryStatus",
+        {"enabled_by_default": False, "entity_category": "diagnostic"},
+    ),
+]
+
+if config["homeassistant"]["sensor"]:
+    DEVICE_BLOCK = build_device_block()
+    _HA_AUTOCONFIG = build_ha_autoconfig()
+else:
+    DEVICE_BLOCK = None
+    _HA_AUTOCONFIG = []
 
 if __name__ == "__main__":
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     client.on_connect = mqtt_on_connect
+    client.on_message = mqtt_on_message
     client.username_pw_set(config["mqtt"]["username"], config["mqtt"]["password"])
-    client.connect(config["mqtt"]["broker"], config["mqtt"]["port"], 60)
+    client.max_inflight_messages_set(128)
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+    # Keepalive of two publish periods avoids needless PINGREQs, but the broker only fires the Last Will
+    # after 1.5x keepalive, so cap it at 300 s to keep HA's "offline" within 7.5 minutes of a lost connection
+    keepalive = min(300, max(60, int(2 * PERIOD)))
+    client.connect(config["mqtt"]["broker"], config["mqtt"]["port"], keepalive)
     print("PiJuice connected to MQTT broker")
 
-    signal.signal(signal.SIGINT, on_exit)
-    signal.signal(signal.SIGTERM, on_exit)
-
-    publish_pijuice()
-    client.loop_forever()
+    client.loop_start()  # paho network loop runs in its own thread
+    asyncio.run(main())